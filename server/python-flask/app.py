@@ -12,35 +12,103 @@ This server implements comprehensive security measures for file uploads:
 
 import os
 import hashlib
+import io
+import json
 import mimetypes
 import secrets
 import logging
+import socket
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
 from datetime import datetime
 from pathlib import Path
 from werkzeug.utils import secure_filename
 from werkzeug.exceptions import RequestEntityTooLarge
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Request, Response, request, jsonify, make_response, send_from_directory
 from flask_cors import CORS
 import magic  # python-magic for MIME type detection
 
+try:
+    from blake3 import blake3  # optional, faster integrity hashing
+except ImportError:
+    blake3 = None
+
 # ============================================================================
 # Configuration
 # ============================================================================
 
 app = Flask(__name__)
 
+
+class JSONFormatter(logging.Formatter):
+    """
+    One JSON object per log line for log pipelines
+    Fields passed via extra= (e.g. size, mime, hash on uploads) are
+    emitted as top-level keys so they don't need to be parsed back out
+    of the message
+    """
+
+    _RESERVED = frozenset(logging.LogRecord('', 0, '', 0, '', (), None).__dict__) | {'message', 'asctime'}
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, self.datefmt),
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in self._RESERVED:
+                entry[key] = value
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
 # Configure logging
+_log_handler = logging.StreamHandler()
+if os.getenv('LOG_FORMAT') == 'json':
+    _log_handler.setFormatter(JSONFormatter(datefmt='%Y-%m-%dT%H:%M:%S'))
+else:
+    _log_handler.setFormatter(logging.Formatter(
+        '[%(asctime)s] %(levelname)s - %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S'
+    ))
+
+# Unknown level names would make basicConfig() raise at import
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+_log_level_valid = isinstance(logging.getLevelName(LOG_LEVEL), int)
+
 logging.basicConfig(
-    level=logging.INFO,
-    format='[%(asctime)s] %(levelname)s - %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
+    level=LOG_LEVEL if _log_level_valid else logging.INFO,
+    handlers=[_log_handler]
 )
 logger = logging.getLogger(__name__)
+if not _log_level_valid:
+    logger.warning("Unknown LOG_LEVEL %r, using INFO", LOG_LEVEL)
 
 # Upload configuration
 UPLOAD_FOLDER = os.path.join(os.path.dirname(__file__), 'uploads')
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB in bytes
-ALLOWED_EXTENSIONS = {'.pdf', '.doc', '.docx', '.txt', '.jpg', '.jpeg', '.png', '.gif'}
+ALLOWED_EXTENSIONS = frozenset({'.pdf', '.doc', '.docx', '.txt', '.jpg', '.jpeg', '.png', '.gif'})
+STREAM_CHUNK_SIZE = 1024 * 1024  # 1MB read size when streaming uploads to disk
+MAGIC_HEADER_SIZE = 16 * 1024  # Bytes handed to libmagic for type detection
+MAX_BATCH_FILES = 64  # Files accepted per /api/upload-batch request
+SPOOL_MAX_SIZE = 4 * 1024 * 1024  # Multipart requests up to this size are parsed in memory
+SPOOL_MEMORY_BUDGET = int(os.getenv('SPOOL_MEMORY_BUDGET', 64 * 1024 * 1024))  # Per worker
+
+# Integrity hash for uploads. blake2b ships with hashlib and outruns SHA-256;
+# blake3 (pip install blake3) is faster still. sha256 remains available
+HASH_ALGORITHM = os.getenv('HASH_ALGORITHM', 'blake2b').lower()
+if HASH_ALGORITHM == 'blake3' and blake3 is None:
+    logger.warning("HASH_ALGORITHM=blake3 but the blake3 package is not installed, using blake2b")
+    HASH_ALGORITHM = 'blake2b'
+
+# Page-cache hints (Linux only)
+POSIX_FADV_SEQUENTIAL = getattr(os, 'POSIX_FADV_SEQUENTIAL', None)
+POSIX_FADV_DONTNEED = getattr(os, 'POSIX_FADV_DONTNEED', None)
 
 # MIME type validation mapping
 ALLOWED_MIME_TYPES = {
@@ -53,37 +121,189 @@ ALLOWED_MIME_TYPES = {
     'image/gif': ['.gif']
 }
 
+# Leading-byte signatures per extension, checked before libmagic. A mismatch
+# is rejected outright; a match is conclusive when a MIME type is given,
+# otherwise (container formats) libmagic still makes the final call
+HEADER_SIGNATURES = {
+    '.pdf': ((b'%PDF-',), 'application/pdf'),
+    '.png': ((b'\x89PNG\r\n\x1a\n',), 'image/png'),
+    '.gif': ((b'GIF87a', b'GIF89a'), 'image/gif'),
+    '.jpg': ((b'\xff\xd8\xff',), 'image/jpeg'),
+    '.jpeg': ((b'\xff\xd8\xff',), 'image/jpeg'),
+    '.docx': ((b'PK\x03\x04',), None),
+    '.doc': ((b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1',), None),
+}
+
+# Inverted lookup table of every allowed (extension, MIME type) pair
+_EXT_MIME_PAIRS = frozenset(
+    (ext, mime) for mime, exts in ALLOWED_MIME_TYPES.items() for ext in exts
+)
+
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE
 
+# Resolved once so path safety checks don't re-resolve the base on every call
+_UPLOAD_ABS = os.path.realpath(UPLOAD_FOLDER)
+
+
+# Scan cache - remembers validation/scan verdicts by content hash so duplicate
+# uploads skip libmagic and the virus scanner. Entries are keyed on the
+# signature database version clamd reports, so a signature update invalidates
+# them; without clamd the cache is not used.
+SCAN_CACHE_DB = os.getenv('SCAN_CACHE_DB', os.path.join(os.path.dirname(__file__), 'data', 'scan_cache.db'))
+
+# ClamAV - set CLAMD_SOCKET (e.g. /var/run/clamav/clamd.ctl) to scan uploads
+# with clamd as they stream in
+CLAMD_SOCKET = os.getenv('CLAMD_SOCKET')
+CLAMD_TIMEOUT = int(os.getenv('CLAMD_TIMEOUT', 30))
+CLAMD_VERSION_TTL = 60  # Seconds between signature version checks
+
+# Downloads - when served behind nginx, hand the file off via X-Accel-Redirect
+# instead of streaming it through the worker (see SETUP_GUIDE.md)
+USE_X_ACCEL = os.getenv('USE_X_ACCEL') == '1'
+X_ACCEL_PREFIX = os.getenv('X_ACCEL_PREFIX', '/_internal_uploads/')
+
+# Pool for blocking work (disk writes, hashing, virus scanning) when running
+# under gevent workers - see gunicorn_conf.py
+BLOCKING_POOL_SIZE = int(os.getenv('BLOCKING_POOL_SIZE', 8))
+
 # CORS configuration - restrict to specific origins in production
 ALLOWED_ORIGINS = os.getenv('ALLOWED_ORIGINS', 'http://localhost:5173,http://localhost:3000').split(',')
 CORS(app, origins=ALLOWED_ORIGINS, methods=['GET', 'POST', 'OPTIONS'])
 
+# ============================================================================
+# Upload Spooling
+# ============================================================================
+
+_spool_lock = threading.Lock()
+_spool_in_use = 0
+
+
+class _BudgetedSpool(tempfile.SpooledTemporaryFile):
+    """
+    In-memory spool that hands its reservation back to the worker's
+    SPOOL_MEMORY_BUDGET once it is closed or spills to disk
+    """
+
+    def __init__(self, reserved):
+        super().__init__(max_size=SPOOL_MAX_SIZE, mode='wb+', dir=UPLOAD_FOLDER)
+        self._reserved = reserved
+        self.in_memory = True
+
+    def _release(self):
+        global _spool_in_use
+        with _spool_lock:
+            _spool_in_use -= self._reserved
+            self._reserved = 0
+
+    def rollover(self):
+        super().rollover()
+        self.in_memory = False
+        self._release()
+
+    def close(self):
+        self._release()
+        super().close()
+
+
+class UploadRequest(Request):
+    """
+    Request class that keeps small multipart uploads in memory
+    Parts are spooled in RAM only when the whole request body fits in
+    SPOOL_MAX_SIZE and the worker's SPOOL_MEMORY_BUDGET has room for it,
+    so the only disk write is the final saved copy. Anything else goes
+    straight to an unnamed file in UPLOAD_FOLDER, which also keeps the
+    parsing cost linear in the upload size
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        global _spool_in_use
+        if total_content_length and total_content_length <= SPOOL_MAX_SIZE:
+            with _spool_lock:
+                if _spool_in_use + total_content_length <= SPOOL_MEMORY_BUDGET:
+                    _spool_in_use += total_content_length
+                    return _BudgetedSpool(total_content_length)
+        return tempfile.TemporaryFile('wb+', dir=UPLOAD_FOLDER)
+
+
+app.request_class = UploadRequest
+
+# ============================================================================
+# Per-thread Resources
+# ============================================================================
+
+def _native_thread_local_class():
+    """
+    Return a thread-local class bound to OS threads
+    gevent patches threading.local to be greenlet-local, which would give
+    every connection its own libmagic handle; use the original instead
+    """
+    try:
+        from gevent import monkey
+        return monkey.get_original('threading', 'local')
+    except ImportError:
+        return threading.local
+
+
+_tls = _native_thread_local_class()()
+
+
+def _magic():
+    """
+    Per-thread libmagic handle
+    Loading the magic database is expensive, so each thread opens it once
+    and reuses it instead of sharing one lock-protected handle
+    """
+    m = getattr(_tls, 'magic', None)
+    if m is None:
+        m = _tls.magic = magic.Magic(mime=True)
+    return m
+
+
 # ============================================================================
 # Security Utilities
 # ============================================================================
 
-def get_file_magic_type(file_path):
+def check_header_signature(ext, header):
+    """
+    Cheap signature check before running libmagic
+    Returns (matches, mime): matches is False when the header cannot be
+    a file of this extension; mime is set when the signature alone
+    identifies the type, and None when libmagic is still needed
+    """
+    entry = HEADER_SIGNATURES.get(ext)
+    if entry is None:
+        return True, None
+
+    signatures, mime = entry
+    if not header.startswith(signatures):
+        return False, None
+    return True, mime
+
+
+def get_buffer_magic_type(header):
     """
     Detect file type using magic numbers (file signature)
-    This prevents file type spoofing via extension changes
+    This prevents file type spoofing via extension changes. libmagic only
+    inspects the leading bytes, so the header captured while saving is
+    enough and the file is never re-read
     """
     try:
-        mime = magic.Magic(mime=True)
-        detected_mime = mime.from_file(file_path)
-        return detected_mime
+        return _magic().from_buffer(header)
     except Exception as e:
-        logger.error(f"Error detecting file type: {e}")
+        logger.error("Error detecting file type: %s", e)
         return None
 
 
-def is_allowed_file_type(filename, detected_mime):
+def is_allowed_file_type(ext, detected_mime):
     """
     Validate file type against allowed types
     Checks both extension and MIME type for security
+    Expects the lower-cased extension (including the dot)
     """
-    ext = os.path.splitext(filename)[1].lower()
+    # Fast path: extension and MIME type form an allowed pair
+    if (ext, detected_mime) in _EXT_MIME_PAIRS:
+        return True, None
 
     # Check extension
     if ext not in ALLOWED_EXTENSIONS:
@@ -93,28 +313,33 @@ def is_allowed_file_type(filename, detected_mime):
     if detected_mime not in ALLOWED_MIME_TYPES:
         return False, f"MIME type {detected_mime} not allowed"
 
-    # Verify extension matches MIME type
-    if ext not in ALLOWED_MIME_TYPES[detected_mime]:
-        return False, f"Extension {ext} does not match detected MIME type {detected_mime}"
+    # Extension does not match MIME type
+    return False, f"Extension {ext} does not match detected MIME type {detected_mime}"
+
 
-    return True, None
+def split_upload_filename(original_filename):
+    """
+    Split a client-supplied filename into a sanitized stem and its
+    lower-cased extension, once per upload
+    The extension is taken from the original name so sanitizing can't drop
+    it (e.g. non-ASCII stems); it is only used once validated against
+    ALLOWED_EXTENSIONS
+    """
+    stem, ext = os.path.splitext(original_filename)
+    return secure_filename(stem), ext.lower()
 
 
-def generate_secure_filename(original_filename):
+def generate_secure_filename(name, ext):
     """
     Generate a secure filename to prevent:
     - Path traversal attacks
     - Filename collisions
     - Special character issues
+    Expects the sanitized stem and extension from split_upload_filename()
     """
-    # Sanitize the original filename
-    safe_name = secure_filename(original_filename)
-
-    # Get extension
-    name, ext = os.path.splitext(safe_name)
-
-    # Generate unique identifier
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    # Generate unique identifier (hex nanosecond timestamp keeps names
+    # sortable by upload time without datetime/strftime formatting)
+    timestamp = f"{time.time_ns():016x}"
     random_hash = secrets.token_hex(8)
 
     # Limit name length
@@ -126,68 +351,408 @@ def generate_secure_filename(original_filename):
     return secure_name
 
 
+def shard_filename(file_hash, secure_name):
+    """
+    Relative storage path for an upload, sharded by content hash
+    (e.g. ab/cd/<secure_name>) so no directory grows past a few
+    thousand entries
+    """
+    return f"{file_hash[:2]}/{file_hash[2:4]}/{secure_name}"
+
+
+def sanitize_stored_name(filename):
+    """
+    Sanitize a stored file path from a download URL component by component
+    Accepts sharded (ab/cd/name) and legacy flat names; returns None if
+    any component sanitizes away (e.g. '..') or the path is too deep
+    """
+    parts = [secure_filename(part) for part in filename.split('/')]
+    if len(parts) > 3 or not all(parts):
+        return None
+    return '/'.join(parts)
+
+
 def is_path_safe(file_path, base_directory):
     """
     Prevent path traversal attacks
     Ensures file path is within the allowed directory
     """
     try:
-        abs_base = os.path.abspath(base_directory)
-        abs_file = os.path.abspath(file_path)
-        return abs_file.startswith(abs_base)
+        abs_base = _UPLOAD_ABS if base_directory == UPLOAD_FOLDER else os.path.realpath(base_directory)
+        abs_file = os.path.realpath(file_path)
+        return os.path.commonpath([abs_file, abs_base]) == abs_base
     except Exception as e:
-        logger.error(f"Path safety check failed: {e}")
+        logger.error("Path safety check failed: %s", e)
         return False
 
 
-def calculate_file_hash(file_path, algorithm='sha256'):
+def _is_in_memory_spool(f):
     """
-    Calculate file hash for integrity verification
+    True for an upload spool that hasn't spilled to disk yet
+    Its fileno() would force the rollover we're trying to avoid
     """
-    hash_obj = hashlib.new(algorithm)
+    return isinstance(f, _BudgetedSpool) and f.in_memory
 
-    with open(file_path, 'rb') as f:
-        for chunk in iter(lambda: f.read(4096), b''):
-            hash_obj.update(chunk)
 
-    return hash_obj.hexdigest()
+def _fadvise(f, advice):
+    """
+    Give the kernel a page-cache hint for a whole file
+    No-op where posix_fadvise is unavailable (Windows, macOS) or the
+    object isn't backed by a real file descriptor
+    """
+    if advice is None or _is_in_memory_spool(f):
+        return
+    try:
+        os.posix_fadvise(f.fileno(), 0, 0, advice)
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        pass
+
+
+def new_hash(algorithm):
+    """
+    Create a hash object for any hashlib algorithm or 'blake3'
+    (which needs the optional blake3 package)
+    """
+    if algorithm == 'blake3':
+        if blake3 is None:
+            raise ValueError("blake3 hashing requires the blake3 package")
+        return blake3()
+    return hashlib.new(algorithm)
+
+
+def save_file_stream(stream, file_path, algorithm=HASH_ALGORITHM, scan=True):
+    """
+    Write an upload to disk in a single pass
+    Hashes the content and captures the header bytes needed for
+    magic number detection while writing, so the saved file never
+    has to be re-read. When ClamAV is configured and scan is set the
+    chunks are also streamed to clamd as they land, and the verdict is
+    returned; otherwise the scan result is None
+    """
+    hash_obj = new_hash(algorithm)
+    header = b''
+    file_size = 0
+
+    # Opened here rather than by the caller so the socket belongs to the
+    # thread that uses it (this may run on the blocking pool)
+    scanner = ClamdStreamScan(CLAMD_SOCKET) if CLAMD_SOCKET and scan else None
+
+    # Read into one buffer when the stream allows it, so no new bytes object
+    # is allocated per chunk. Not the per-thread buffer: raw uploads run
+    # inline under gevent, where greenlets sharing a thread could interleave
+    readinto = getattr(stream, 'readinto', None)
+    buf = bytearray(STREAM_CHUNK_SIZE)
+    view = memoryview(buf)
+    _fadvise(stream, POSIX_FADV_SEQUENTIAL)
+
+    try:
+        with open(file_path, 'wb', buffering=0) as out:
+            while True:
+                if readinto is not None:
+                    n = readinto(buf)
+                    chunk = view[:n] if n else None
+                else:
+                    chunk = stream.read(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                if len(header) < MAGIC_HEADER_SIZE:
+                    header += bytes(chunk[:MAGIC_HEADER_SIZE - len(header)])
+                hash_obj.update(chunk)
+                out.write(chunk)
+                if scanner:
+                    scanner.send(chunk)
+                file_size += len(chunk)
+
+            # Unless clamd still has to scan it, nothing reads the saved copy
+            # back (hash and header were taken above), so start writeback
+            # now and let the kernel drop its pages instead of evicting
+            # hotter data later
+            if scanner or not CLAMD_SOCKET:
+                _fadvise(out, POSIX_FADV_DONTNEED)
+
+        scan_result = scanner.result() if scanner else None
+    finally:
+        if scanner:
+            scanner.close()
+
+    return file_size, header, hash_obj.hexdigest(), scan_result
+
+
+def _clamd_reply(sock):
+    """Read one NUL-terminated clamd reply"""
+    reply = b''
+    while not reply.endswith(b'\0'):
+        data = sock.recv(4096)
+        if not data:
+            break
+        reply += data
+    return reply.rstrip(b'\0').decode('utf-8', 'replace')
+
+
+_clamd_version = None
+_clamd_version_checked = float('-inf')
+
+
+def clamd_signature_version():
+    """
+    Engine and signature database version reported by clamd's VERSION
+    command, e.g. "ClamAV 1.0.5/27186"
+    Re-queried at most every CLAMD_VERSION_TTL seconds, so a signature
+    update is picked up within that window
+    """
+    global _clamd_version, _clamd_version_checked
+
+    now = time.monotonic()
+    if now - _clamd_version_checked < CLAMD_VERSION_TTL:
+        return _clamd_version
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(CLAMD_TIMEOUT)
+        sock.connect(CLAMD_SOCKET)
+        sock.sendall(b'zVERSION\0')
+        reply = _clamd_reply(sock)
+    finally:
+        sock.close()
+
+    # Replies look like "ClamAV 1.0.5/27186/Tue Feb 27 08:24:48 2024"
+    _clamd_version = '/'.join(reply.split('/')[:2]) or None
+    _clamd_version_checked = now
+    return _clamd_version
+
+
+class ClamdStreamScan:
+    """
+    Incremental ClamAV scan over clamd's INSTREAM command
+    Chunks are pushed to clamd as they are sent, so the scan runs
+    alongside the upload instead of re-reading the saved file afterwards
+    """
+
+    def __init__(self, socket_path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.settimeout(CLAMD_TIMEOUT)
+            self.sock.connect(socket_path)
+            self.sock.sendall(b'zINSTREAM\0')
+        except OSError:
+            self.sock.close()
+            raise
+
+    def send(self, chunk):
+        """Stream one chunk (length-prefixed, as INSTREAM expects)"""
+        self.sock.sendall(struct.pack('!L', len(chunk)))
+        self.sock.sendall(chunk)
+
+    def result(self):
+        """Finish the stream and return the scan verdict"""
+        self.sock.sendall(struct.pack('!L', 0))
+        reply = _clamd_reply(self.sock)
+
+        # Replies look like "stream: OK" or "stream: <signature> FOUND"
+        status = reply.partition(': ')[2]
+        if status == 'OK':
+            return {'clean': True, 'threats': []}
+        if status.endswith(' FOUND'):
+            return {'clean': False, 'threats': [status[:-len(' FOUND')]]}
+        raise RuntimeError(f"clamd scan failed: {reply}")
+
+    def close(self):
+        self.sock.close()
 
 
 def scan_file_for_viruses(file_path):
     """
-    Virus scanning placeholder
-    In production, integrate with:
-    - ClamAV (python-clamd)
+    Scan a stored file for viruses
+    Uses clamd's INSTREAM when CLAMD_SOCKET is configured. Raw uploads
+    are scanned while streaming in (see save_file_stream); multipart
+    uploads are scanned here after a scan cache miss. Without ClamAV no
+    scan is done and None is returned - in production, integrate with:
+    - ClamAV (clamd)
     - VirusTotal API
     - AWS GuardDuty
+    Runs on the blocking pool, so it must not log (see run_blocking)
+    """
+    if CLAMD_SOCKET:
+        scanner = ClamdStreamScan(CLAMD_SOCKET)
+        try:
+            # One buffer per call: sendall() can yield under gevent
+            buf = bytearray(STREAM_CHUNK_SIZE)
+            view = memoryview(buf)
+            with open(file_path, 'rb') as f:
+                while n := f.readinto(buf):
+                    scanner.send(view[:n])
+            return scanner.result()
+        finally:
+            scanner.close()
+
+    return None
+
+
+# ============================================================================
+# Helper Functions
+# ============================================================================
+
+def _create_blocking_executor():
+    """
+    Build the pool used by run_blocking()
+    Under gevent the stdlib threading module is monkey-patched, so a plain
+    ThreadPoolExecutor would only spawn greenlets; gevent's own executor
+    runs on native threads and lets the calling greenlet yield meanwhile
     """
-    logger.info(f"[SECURITY] Virus scan needed for: {file_path}")
+    try:
+        from gevent import monkey
+    except ImportError:
+        return None
 
-    # TODO: Integrate with actual antivirus solution
-    # Example with ClamAV:
-    # import clamd
-    # cd = clamd.ClamdUnixSocket()
-    # scan_result = cd.scan(file_path)
+    if not monkey.is_module_patched('threading'):
+        return None
+
+    from gevent.threadpool import ThreadPoolExecutor
+    return ThreadPoolExecutor(max_workers=BLOCKING_POOL_SIZE)
+
+
+_blocking_executor = _create_blocking_executor()
 
-    # For now, return clean
-    return {'clean': True, 'threats': []}
 
+def run_blocking(func, *args):
+    """
+    Run CPU/disk-bound work without stalling the event loop
+    Offloads to a native thread pool under gevent workers; with sync or
+    threaded workers the call simply runs inline. func must not log:
+    on the pool's threads logging's handler lock is gevent's patched
+    lock, which native threads can deadlock on. Return or raise instead
+    and log from the caller
+    """
+    if _blocking_executor is None:
+        return func(*args)
+    return _blocking_executor.submit(func, *args).result()
 
-def validate_file_size(file_path, max_size):
+
+def init_scan_cache():
     """
-    Verify file size (server-side double-check)
+    Create the scan cache database once at startup
+    WAL mode lets lookups in other workers proceed while one writes
     """
     try:
-        file_size = os.path.getsize(file_path)
-        return file_size <= max_size, file_size
-    except Exception as e:
-        logger.error(f"Error checking file size: {e}")
-        return False, 0
+        Path(SCAN_CACHE_DB).parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(SCAN_CACHE_DB, timeout=5)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            with conn:
+                conn.execute(
+                    'CREATE TABLE IF NOT EXISTS scan_cache ('
+                    'hash TEXT PRIMARY KEY, mime TEXT, clean INTEGER, ts REAL, sig_ver TEXT, path TEXT)'
+                )
+        finally:
+            conn.close()
+    except (OSError, sqlite3.Error) as e:
+        logger.error("Scan cache setup failed: %s", e)
+
+
+def _scan_cache_connection():
+    """
+    Per-thread scan cache connection
+    Cache calls go through run_blocking(), so under gevent these live on
+    the blocking pool's native threads rather than one per request
+    """
+    conn = getattr(_tls, 'scan_cache', None)
+    if conn is None:
+        conn = _tls.scan_cache = sqlite3.connect(SCAN_CACHE_DB, timeout=5)
+    return conn
 
 
-# ============================================================================
-# Helper Functions
-# ============================================================================
+def lookup_scan_cache(file_hash, sig_version):
+    """
+    Return the cached verdict for a content hash, or None on a miss
+    Entries recorded under a different signature database version are
+    ignored so files get rescanned after a signature update
+    """
+    row = _scan_cache_connection().execute(
+        'SELECT mime, clean, path FROM scan_cache WHERE hash = ? AND sig_ver = ?',
+        (file_hash, sig_version)
+    ).fetchone()
+    if row is None:
+        return None
+    return {'mime': row[0], 'clean': bool(row[1]), 'path': row[2]}
+
+
+def record_scan_cache(file_hash, mime, clean, file_path, sig_version):
+    """Store the validation/scan verdict for a content hash"""
+    conn = _scan_cache_connection()
+    with conn:
+        conn.execute(
+            'INSERT OR REPLACE INTO scan_cache (hash, mime, clean, ts, sig_ver, path) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (file_hash, mime, int(clean), time.time(), sig_version, file_path)
+        )
+
+
+def scan_cache_version():
+    """
+    Signature version to key the scan cache on, or None to bypass the
+    cache (no clamd configured, or clamd didn't answer)
+    """
+    if not CLAMD_SOCKET:
+        return None
+    try:
+        return clamd_signature_version()
+    except OSError as e:
+        logger.error("clamd version check failed: %s", e)
+        return None
+
+
+def cached_verdict(file_hash, sig_version):
+    """
+    Look up the scan cache on the blocking pool
+    Failures are logged here, on the request's own thread, and treated
+    as a miss
+    """
+    if not sig_version:
+        return None
+    try:
+        return run_blocking(lookup_scan_cache, file_hash, sig_version)
+    except sqlite3.Error as e:
+        logger.error("Scan cache lookup failed: %s", e)
+        return None
+
+
+def remember_verdict(file_hash, mime, clean, file_path, sig_version):
+    """Record a verdict on the blocking pool, logging failures here"""
+    if not sig_version:
+        return
+    try:
+        run_blocking(record_scan_cache, file_hash, mime, clean, file_path, sig_version)
+    except sqlite3.Error as e:
+        logger.error("Scan cache update failed: %s", e)
+
+
+def link_existing_blob(existing_path, file_path):
+    """
+    Replace a freshly written duplicate with a hard link to the stored copy
+    Returns True if the link was made; on any failure the new file is kept
+    """
+    if not existing_path or existing_path == file_path:
+        return False
+    if not is_path_safe(existing_path, app.config['UPLOAD_FOLDER']):
+        return False
+
+    tmp_path = f"{file_path}.link"
+    try:
+        os.link(existing_path, tmp_path)
+        os.replace(tmp_path, file_path)
+        return True
+    except OSError:
+        cleanup_file(tmp_path)
+        return False
+
+
+def move_to_shard(file_path, stored_name):
+    """Move a saved upload from the upload root into its shard directory"""
+    final_path = os.path.join(app.config['UPLOAD_FOLDER'], stored_name)
+    os.makedirs(os.path.dirname(final_path), exist_ok=True)
+    os.rename(file_path, final_path)
+    return final_path
+
 
 def ensure_upload_directory():
     """Create upload directory if it doesn't exist"""
@@ -197,11 +762,207 @@ def ensure_upload_directory():
 def cleanup_file(file_path):
     """Safely remove a file"""
     try:
-        if os.path.exists(file_path):
-            os.remove(file_path)
-            logger.info(f"Cleaned up file: {file_path}")
+        os.unlink(file_path)
+        logger.info("Cleaned up file: %s", file_path)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.error("Error cleaning up file %s: %s", file_path, e)
+
+
+# ============================================================================
+# Upload Processing
+# ============================================================================
+
+def process_upload(stream, original_filename, offload_save=True):
+    """
+    Validate, store and scan an uploaded file stream
+    Returns the JSON response body and HTTP status code
+    Shared by the multipart and raw upload endpoints. Pass
+    offload_save=False when stream reads from the client socket, which
+    gevent only allows on the request's own thread; only then is the
+    upload streamed to clamd while it arrives. An already-spooled
+    multipart body is hashed first so cached duplicates skip the scan
+    """
+    name, ext = split_upload_filename(original_filename)
+
+    # VALIDATION #3: Initial extension check
+    if ext not in ALLOWED_EXTENSIONS:
+        return {
+            'success': False,
+            'error': f'File type not allowed. Allowed types: {", ".join(ALLOWED_EXTENSIONS)}'
+        }, 400
+
+    # Ensure upload directory exists
+    ensure_upload_directory()
+
+    # Generate secure filename
+    secure_name = generate_secure_filename(name, ext)
+    file_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_name)
+
+    # SECURITY CHECK #1: Verify path safety
+    if not is_path_safe(file_path, app.config['UPLOAD_FOLDER']):
+        logger.warning("[SECURITY] Path traversal attempt detected: %s", original_filename)
+        return {
+            'success': False,
+            'error': 'Invalid file path'
+        }, 400
+
+    try:
+        # Save file temporarily for validation, hashing it and capturing
+        # the header for magic number detection in the same pass
+        if offload_save:
+            file_size, header, file_hash, stream_scan = run_blocking(save_file_stream, stream, file_path,
+                                                                     HASH_ALGORITHM, False)
+        else:
+            file_size, header, file_hash, stream_scan = save_file_stream(stream, file_path)
+        logger.info("File temporarily saved: %s", secure_name)
+
+        # SECURITY CHECK #2: Verify file size
+        if file_size > MAX_FILE_SIZE:
+            cleanup_file(file_path)
+            return {
+                'success': False,
+                'error': f'File size ({file_size / 1024 / 1024:.2f}MB) exceeds maximum allowed size ({MAX_FILE_SIZE / 1024 / 1024}MB)'
+            }, 400
+
+        # Duplicate of an upload already verified against the current
+        # signatures? Reuse its verdict
+        sig_version = scan_cache_version()
+        cached = cached_verdict(file_hash, sig_version)
+
+        # SECURITY CHECK #3: Verify file type using magic numbers
+        if cached:
+            detected_mime = cached['mime']
+        else:
+            signature_ok, detected_mime = check_header_signature(ext, header)
+            if not signature_ok:
+                cleanup_file(file_path)
+                logger.warning("[SECURITY] File signature mismatch: %s", original_filename)
+                return {
+                    'success': False,
+                    'error': f'File content does not match extension {ext}'
+                }, 400
+            if not detected_mime:
+                detected_mime = get_buffer_magic_type(header)
+
+        if not detected_mime:
+            cleanup_file(file_path)
+            return {
+                'success': False,
+                'error': 'Could not verify file type'
+            }, 400
+
+        # SECURITY CHECK #4: Validate file type against allowed types
+        is_valid, error_msg = is_allowed_file_type(ext, detected_mime)
+        if not is_valid:
+            cleanup_file(file_path)
+            logger.warning("[SECURITY] Invalid file type: %s - %s", original_filename, error_msg)
+            return {
+                'success': False,
+                'error': error_msg
+            }, 400
+
+        # SECURITY CHECK #5: Virus scanning (already done if streamed to clamd,
+        # skipped for duplicates of an already-scanned upload)
+        placeholder_scan = False
+        if stream_scan:
+            scan_result = stream_scan
+        elif cached:
+            scan_result = {'clean': cached['clean'], 'threats': [] if cached['clean'] else ['cached']}
+        else:
+            scan_result = run_blocking(scan_file_for_viruses, file_path)
+            if scan_result is None:
+                logger.info("[SECURITY] Virus scan needed for: %s", file_path)
+
+                # For now, return clean
+                scan_result = {'clean': True, 'threats': []}
+                placeholder_scan = True
+
+        # Placeholder verdicts are never cached: once a real scanner is
+        # enabled, duplicates of files that were never scanned must not
+        # be waved through
+        remember = not cached and not placeholder_scan
+
+        if not scan_result['clean']:
+            if remember:
+                remember_verdict(file_hash, detected_mime, False, None, sig_version)
+            cleanup_file(file_path)
+            logger.error("[SECURITY ALERT] Malicious file detected: %s - %s", original_filename, scan_result['threats'])
+            return {
+                'success': False,
+                'error': 'File failed security scan'
+            }, 400
+
+        # Accepted - only now move into the shard for its content hash, so
+        # rejected uploads never create shard directories
+        stored_name = shard_filename(file_hash, secure_name)
+        file_path = move_to_shard(file_path, stored_name)
+
+        if remember:
+            remember_verdict(file_hash, detected_mime, True, file_path, sig_version)
+
+        # Store duplicates as hard links to the first copy
+        if cached:
+            link_existing_blob(cached['path'], file_path)
+
+        # Log successful upload
+        logger.info(
+            "[SUCCESS] File uploaded: %s size=%d mime=%s %s=%s...",
+            stored_name, file_size, detected_mime, HASH_ALGORITHM, file_hash[:16],
+            extra={'file': stored_name, 'size': file_size, 'mime': detected_mime,
+                   'hash': file_hash, 'hash_algorithm': HASH_ALGORITHM}
+        )
+
+        # Return success response
+        return {
+            'success': True,
+            'data': {
+                'url': f'/api/files/{stored_name}',
+                'name': original_filename,
+                'size': file_size,
+                'mime_type': detected_mime,
+                'hash': file_hash,
+                'hash_algorithm': HASH_ALGORITHM,
+                'uploaded_at': datetime.now().isoformat()
+            }
+        }, 200
+
     except Exception as e:
-        logger.error(f"Error cleaning up file {file_path}: {e}")
+        # Clean up on error
+        cleanup_file(file_path)
+        raise e
+
+
+# ============================================================================
+# Pre-serialized Responses
+# ============================================================================
+
+# Bodies that never change after startup are encoded once instead of
+# being rebuilt and re-serialized by jsonify() on every request
+_TOO_LARGE_BODY = json.dumps({
+    'success': False,
+    'error': f'File too large. Maximum size: {MAX_FILE_SIZE / 1024 / 1024}MB'
+}).encode()
+
+_NOT_FOUND_BODY = json.dumps({
+    'success': False,
+    'error': 'Endpoint not found'
+}).encode()
+
+# Everything but the timestamp, left open so health_check() can append it
+_HEALTH_BODY_PREFIX = json.dumps({
+    'status': 'ok',
+    'max_file_size': f"{MAX_FILE_SIZE / 1024 / 1024}MB",
+    'allowed_extensions': sorted(ALLOWED_EXTENSIONS),
+    'allowed_mime_types': list(ALLOWED_MIME_TYPES.keys()),
+    'timestamp': ''
+}).encode()[:-2]
+
+
+def static_json_response(body, status):
+    """Wrap an already-encoded JSON body in a response"""
+    return Response(body, status=status, mimetype='application/json')
 
 
 # ============================================================================
@@ -211,13 +972,10 @@ def cleanup_file(file_path):
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
-    return jsonify({
-        'status': 'ok',
-        'timestamp': datetime.now().isoformat(),
-        'max_file_size': f"{MAX_FILE_SIZE / 1024 / 1024}MB",
-        'allowed_extensions': list(ALLOWED_EXTENSIONS),
-        'allowed_mime_types': list(ALLOWED_MIME_TYPES.keys())
-    }), 200
+    # Only the timestamp changes between calls; splice it onto the
+    # pre-serialized body
+    body = _HEALTH_BODY_PREFIX + datetime.now().isoformat().encode() + b'"}'
+    return static_json_response(body, 200)
 
 
 @app.route('/api/upload', methods=['POST'])
@@ -243,142 +1001,160 @@ def upload_file():
                 'error': 'No file selected'
             }), 400
 
-        # VALIDATION #3: Initial extension check
-        ext = os.path.splitext(file.filename)[1].lower()
-        if ext not in ALLOWED_EXTENSIONS:
-            return jsonify({
-                'success': False,
-                'error': f'File type not allowed. Allowed types: {", ".join(ALLOWED_EXTENSIONS)}'
-            }), 400
+        body, status = process_upload(file.stream, file.filename)
+        return jsonify(body), status
 
-        # Ensure upload directory exists
-        ensure_upload_directory()
+    except RequestEntityTooLarge:
+        return static_json_response(_TOO_LARGE_BODY, 413)
 
-        # Generate secure filename
-        secure_name = generate_secure_filename(file.filename)
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_name)
+    except Exception as e:
+        logger.error("Upload error: %s", e)
+        return jsonify({
+            'success': False,
+            'error': 'Upload failed. Please try again.'
+        }), 500
 
-        # SECURITY CHECK #1: Verify path safety
-        if not is_path_safe(file_path, app.config['UPLOAD_FOLDER']):
-            logger.warning(f"[SECURITY] Path traversal attempt detected: {file.filename}")
+
+@app.route('/api/upload-raw', methods=['POST'])
+def upload_file_raw():
+    """
+    Raw body upload endpoint
+    Accepts the file as the request body (e.g. application/octet-stream)
+    with its name in the X-Filename header, skipping multipart parsing
+    entirely so large files are streamed straight to disk
+    """
+    try:
+        # VALIDATION #1: Check if a body was sent
+        if request.content_length == 0:
             return jsonify({
                 'success': False,
-                'error': 'Invalid file path'
+                'error': 'No file provided'
             }), 400
 
-        # Save file temporarily for validation
-        file.save(file_path)
-        logger.info(f"File temporarily saved: {secure_name}")
-
-        try:
-            # SECURITY CHECK #2: Verify file size
-            size_valid, file_size = validate_file_size(file_path, MAX_FILE_SIZE)
-            if not size_valid:
-                cleanup_file(file_path)
-                return jsonify({
-                    'success': False,
-                    'error': f'File size ({file_size / 1024 / 1024:.2f}MB) exceeds maximum allowed size ({MAX_FILE_SIZE / 1024 / 1024}MB)'
-                }), 400
-
-            # SECURITY CHECK #3: Verify file type using magic numbers
-            detected_mime = get_file_magic_type(file_path)
+        # VALIDATION #2: Check if file has a filename
+        original_filename = request.headers.get('X-Filename', '')
+        if original_filename == '':
+            return jsonify({
+                'success': False,
+                'error': 'No file selected'
+            }), 400
 
-            if not detected_mime:
-                cleanup_file(file_path)
-                return jsonify({
-                    'success': False,
-                    'error': 'Could not verify file type'
-                }), 400
+        body, status = process_upload(request.stream, original_filename, offload_save=False)
+        return jsonify(body), status
 
-            # SECURITY CHECK #4: Validate file type against allowed types
-            is_valid, error_msg = is_allowed_file_type(file.filename, detected_mime)
-            if not is_valid:
-                cleanup_file(file_path)
-                logger.warning(f"[SECURITY] Invalid file type: {file.filename} - {error_msg}")
-                return jsonify({
-                    'success': False,
-                    'error': error_msg
-                }), 400
+    except RequestEntityTooLarge:
+        return static_json_response(_TOO_LARGE_BODY, 413)
 
-            # SECURITY CHECK #5: Virus scanning
-            scan_result = scan_file_for_viruses(file_path)
-            if not scan_result['clean']:
-                cleanup_file(file_path)
-                logger.error(f"[SECURITY ALERT] Malicious file detected: {file.filename} - {scan_result['threats']}")
-                return jsonify({
-                    'success': False,
-                    'error': 'File failed security scan'
-                }), 400
+    except Exception as e:
+        logger.error("Upload error: %s", e)
+        return jsonify({
+            'success': False,
+            'error': 'Upload failed. Please try again.'
+        }), 500
 
-            # Calculate file hash for integrity
-            file_hash = calculate_file_hash(file_path)
 
-            # Log successful upload
-            logger.info(f"[SUCCESS] File uploaded: {secure_name} ({file_size} bytes, {detected_mime}, SHA256: {file_hash[:16]}...)")
+@app.route('/api/upload-batch', methods=['POST'])
+def upload_files_batch():
+    """
+    Batch upload endpoint
+    Accepts up to MAX_BATCH_FILES files under the 'files' field of one
+    multipart request, saving a round trip and request setup per file
+    when clients send many small files; each file is validated
+    independently and gets its own result entry. MAX_CONTENT_LENGTH
+    still applies to the whole request, so the files together must fit
+    in MAX_FILE_SIZE
+    """
+    try:
+        # VALIDATION #1: Check if files are in request
+        files = request.files.getlist('files')
+        if not files:
+            return jsonify({
+                'success': False,
+                'error': 'No file provided'
+            }), 400
 
-            # Return success response
+        if len(files) > MAX_BATCH_FILES:
             return jsonify({
-                'success': True,
-                'data': {
-                    'url': f'/api/files/{secure_name}',
-                    'name': file.filename,
-                    'size': file_size,
-                    'mime_type': detected_mime,
-                    'hash': file_hash,
-                    'uploaded_at': datetime.now().isoformat()
+                'success': False,
+                'error': f'Too many files. Maximum per batch: {MAX_BATCH_FILES}'
+            }), 400
+
+        results = []
+        for file in files:
+            # VALIDATION #2: Check if file has a filename
+            if file.filename == '':
+                results.append({
+                    'success': False,
+                    'error': 'No file selected'
+                })
+                continue
+
+            try:
+                body, _ = process_upload(file.stream, file.filename)
+            except Exception as e:
+                logger.error("Upload error: %s", e)
+                body = {
+                    'success': False,
+                    'error': 'Upload failed. Please try again.'
                 }
-            }), 200
+            results.append(body)
 
-        except Exception as e:
-            # Clean up on error
-            cleanup_file(file_path)
-            raise e
+        return jsonify({
+            'success': all(result['success'] for result in results),
+            'data': results
+        }), 200
 
     except RequestEntityTooLarge:
-        return jsonify({
-            'success': False,
-            'error': f'File too large. Maximum size: {MAX_FILE_SIZE / 1024 / 1024}MB'
-        }), 413
+        return static_json_response(_TOO_LARGE_BODY, 413)
 
     except Exception as e:
-        logger.error(f"Upload error: {str(e)}")
+        logger.error("Upload error: %s", e)
         return jsonify({
             'success': False,
             'error': 'Upload failed. Please try again.'
         }), 500
 
 
-@app.route('/api/files/<filename>', methods=['GET'])
+@app.route('/api/files/<path:filename>', methods=['GET'])
 def get_file(filename):
     """
     Serve uploaded files with security checks
     """
     try:
-        # Sanitize filename
-        safe_filename = secure_filename(filename)
+        # Sanitize filename (including its shard prefix)
+        safe_filename = sanitize_stored_name(filename)
 
         # Verify path safety
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], safe_filename)
-        if not is_path_safe(file_path, app.config['UPLOAD_FOLDER']):
-            logger.warning(f"[SECURITY] Path traversal attempt: {filename}")
+        file_path = os.path.join(app.config['UPLOAD_FOLDER'], safe_filename or '')
+        if not safe_filename or not is_path_safe(file_path, app.config['UPLOAD_FOLDER']):
+            logger.warning("[SECURITY] Path traversal attempt: %s", filename)
             return jsonify({
                 'success': False,
                 'error': 'Access denied'
             }), 403
 
         # Check if file exists
-        if not os.path.exists(file_path):
+        if not os.path.isfile(file_path):
             return jsonify({
                 'success': False,
                 'error': 'File not found'
             }), 404
 
         # Send file with security headers
-        response = send_from_directory(
-            app.config['UPLOAD_FOLDER'],
-            safe_filename,
-            as_attachment=True
-        )
+        if USE_X_ACCEL:
+            # Let the reverse proxy stream the file (zero-copy sendfile).
+            # nginx drops the security headers below on X-Accel-Redirect;
+            # its internal location must add them (see SETUP_GUIDE.md)
+            response = make_response('')
+            response.headers['X-Accel-Redirect'] = f"{X_ACCEL_PREFIX}{safe_filename}"
+            response.headers['Content-Type'] = mimetypes.guess_type(safe_filename)[0] or 'application/octet-stream'
+            response.headers['Content-Disposition'] = f'attachment; filename="{os.path.basename(safe_filename)}"'
+        else:
+            response = send_from_directory(
+                app.config['UPLOAD_FOLDER'],
+                safe_filename,
+                as_attachment=True
+            )
 
         # Add security headers
         response.headers['X-Content-Type-Options'] = 'nosniff'
@@ -388,7 +1164,7 @@ def get_file(filename):
         return response
 
     except Exception as e:
-        logger.error(f"File serving error: {str(e)}")
+        logger.error("File serving error: %s", e)
         return jsonify({
             'success': False,
             'error': 'Failed to retrieve file'
@@ -402,25 +1178,19 @@ def get_file(filename):
 @app.errorhandler(413)
 def request_entity_too_large(error):
     """Handle file too large error"""
-    return jsonify({
-        'success': False,
-        'error': f'File too large. Maximum size: {MAX_FILE_SIZE / 1024 / 1024}MB'
-    }), 413
+    return static_json_response(_TOO_LARGE_BODY, 413)
 
 
 @app.errorhandler(404)
 def not_found(error):
     """Handle 404 errors"""
-    return jsonify({
-        'success': False,
-        'error': 'Endpoint not found'
-    }), 404
+    return static_json_response(_NOT_FOUND_BODY, 404)
 
 
 @app.errorhandler(500)
 def internal_error(error):
     """Handle internal server errors"""
-    logger.error(f"Internal error: {str(error)}")
+    logger.error("Internal error: %s", error)
     return jsonify({
         'success': False,
         'error': 'Internal server error'
@@ -431,17 +1201,18 @@ def internal_error(error):
 # Server Initialization
 # ============================================================================
 
-if __name__ == '__main__':
-    # Ensure upload directory exists
-    ensure_upload_directory()
+# Ensure upload directory exists (multipart parts spill into it)
+ensure_upload_directory()
+init_scan_cache()
 
+if __name__ == '__main__':
     logger.info("=" * 60)
-    logger.info(f"Secure File Upload Server Starting")
+    logger.info("Secure File Upload Server Starting")
     logger.info("=" * 60)
-    logger.info(f"Max file size: {MAX_FILE_SIZE / 1024 / 1024}MB")
-    logger.info(f"Upload directory: {UPLOAD_FOLDER}")
-    logger.info(f"Allowed extensions: {', '.join(ALLOWED_EXTENSIONS)}")
-    logger.info(f"Allowed MIME types: {', '.join(ALLOWED_MIME_TYPES.keys())}")
+    logger.info("Max file size: %sMB", MAX_FILE_SIZE / 1024 / 1024)
+    logger.info("Upload directory: %s", UPLOAD_FOLDER)
+    logger.info("Allowed extensions: %s", ', '.join(ALLOWED_EXTENSIONS))
+    logger.info("Allowed MIME types: %s", ', '.join(ALLOWED_MIME_TYPES.keys()))
     logger.info("=" * 60)
 
     # Run server
@@ -0,0 +1,24 @@
+"""
+Gunicorn configuration for production deployment
+
+Runs the Flask app on gevent workers so a slow upload only parks a
+greenlet instead of pinning a whole worker. Blocking work inside a
+request (disk writes, hashing, virus scanning) is handed to a native
+thread pool by app.run_blocking().
+
+Usage:
+    gunicorn -c gunicorn_conf.py app:app
+"""
+
+# Patch the standard library before anything else imports socket/ssl
+from gevent import monkey
+monkey.patch_all()
+
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', 5000)}"
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'gevent'
+worker_connections = 1000
+timeout = 120